@@ -7,13 +7,20 @@ Author: Matt Webb
 Version: 1.0
 """
 
+import logging
+import os
+import tempfile
+import numpy as np
 import pandas as pd
+from datetime import date
 from datetime import datetime
 from datetime import timedelta
-from typing import Final, List
+from functools import lru_cache
+from typing import IO, Final, List, Tuple, Union
 
 from pandas_datareader import data
-from collections import Counter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 TRADE_DIRECTION_BUY: Final[str] = "buy"
 TRADE_DIRECTION_SELL: Final[str] = "sell"
@@ -36,7 +43,17 @@ STRATEGY_PARAMETERS: Final[dict] = {
 }
 SUPPORTED_STRATEGIES: Final[List[str]] = [STRATEGY_SLOW, STRATEGY_NORMAL, STRATEGY_STEALTH]
 
+log = logging.getLogger("autohedger")
+
 PRICES_SOURCE = "yahoo"
+PRICES_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "cryptohedger", "prices.csv")
+PRICES_CACHE_TTL = timedelta(hours=1)
+
+
+class UnknownStrategyError(ValueError):
+    """
+    Raised when a hedging strategy is not one of SUPPORTED_STRATEGIES.
+    """
 
 
 class Trade:
@@ -102,6 +119,8 @@ class Book:
         The short name of the book.
     positions: dict
         A dictionary of Position objects keyed by asset name.
+    trade_count: int
+        The number of trades booked into this book.
     Methods
     -------
     trade_add(trade):
@@ -116,6 +135,7 @@ class Book:
         """
         self.name = name
         self.positions = {}
+        self.trade_count = 0
 
     def __str__(self) -> str:
         """
@@ -139,6 +159,7 @@ class Book:
         if asset not in self.positions:
             self.positions[asset] = Position(asset)
         self.positions[asset].trade_add(trade)
+        self.trade_count += 1
 
     def get_positions(self, as_of_time=None) -> dict:
         """
@@ -159,9 +180,9 @@ class Book:
         if as_of_time is None:
             as_of_time = datetime.now()
 
-        trades = pd.DataFrame()
-        for asset, position in self.positions.items():
-            trades = pd.concat([trades, position.get_trades(as_of_time)])
+        if not self.positions:
+            return pd.DataFrame()
+        trades = pd.concat([position.get_trades(as_of_time) for position in self.positions.values()])
         trades = trades.sort_values(by="trade_time")
         return trades
 
@@ -176,6 +197,8 @@ class Portfolio:
         The name of the portfolio.
     books: List[Book]
         The list of Book objects within this Portfolio.
+    net_positions_cache: tuple
+        The last net positions computed, keyed on as of time and book trade counts.
     Methods
     -------
     net_positions: dict
@@ -189,6 +212,7 @@ class Portfolio:
         """
         self.name = name
         self.books = books
+        self.net_positions_cache = (None, None)
 
     def net_positions(self, as_of_time=None) -> dict:
         """
@@ -196,11 +220,19 @@ class Portfolio:
         :param as_of_time: Time to filter the list of trades, default is datetime.now()
         :return: Dictionary of positions from all books
         """
-        counter = Counter()
+        # Positions can only change when a trade is booked, so reuse the
+        # last result if no book has taken a trade since it was computed
+        cache_key = (as_of_time, tuple(book.trade_count for book in self.books))
+        cached_key, cached_positions = self.net_positions_cache
+        if cache_key == cached_key:
+            return dict(cached_positions)
+
+        positions = {}
         for book in self.books:
-            book_positions = book.get_positions(as_of_time)
-            counter.update(book_positions)
-        return counter
+            for asset, quantity in book.get_positions(as_of_time).items():
+                positions[asset] = positions.get(asset, 0) + quantity
+        self.net_positions_cache = (cache_key, positions)
+        return dict(positions)
 
 
 class Position:
@@ -213,15 +245,15 @@ class Position:
         The underlying asset of the position, e.g. BTC.
     quantity: float
         Current total of all trades executed.
-    trades: List[Trade]
-        List of trades contributing to the position.
+    trade_times, books, directions, denominations, quantities, prices: List
+        Columns of the trades contributing to the position, one entry per trade.
     Methods
     -------
     trade_add(trade):
         Adds a given trade to the position, given an object of type Trade.
     get_trades_as_dataframe:
         Returns a data frame of all the trades in the position.
-    get_trades(as_of_time=datetime.now()):
+    get_trades(as_of_time=None):
         Returns a data frame of the trades in the position as of a given time (defaults to datetime.now()).
     get_quantity():
         Returns the quantity of the position, using trade list with an as of filter if passed.
@@ -233,7 +265,12 @@ class Position:
         """
         self.asset = asset
         self.quantity = 0
-        self.trades = []
+        self.trade_times = []
+        self.books = []
+        self.directions = []
+        self.denominations = []
+        self.quantities = []
+        self.prices = []
 
     def __str__(self) -> str:
         """
@@ -247,27 +284,34 @@ class Position:
         Adds a given trade to this position and updates all relevant attributes
         :param trade: The trade to add to this position
         """
-        self.trades.append(trade)
+        self.trade_times.append(trade.trade_time)
+        self.books.append(trade.book)
+        self.directions.append(trade.direction)
+        self.denominations.append(trade.denominated)
+        self.quantities.append(trade.quantity)
+        self.prices.append(trade.price)
         self.quantity += trade.quantity
 
     def get_trades_as_dataframe(self) -> pd.DataFrame:
         """
-        Gets the trades list as a DataFrame
-        :return: DataFrame of trades from trades list
+        Gets the trade columns as a DataFrame
+        :return: DataFrame of trades from trade columns
         """
-        trades = [{"trade_time": trade.trade_time, "book": trade.book, "direction": trade.direction,
-                   "asset": trade.asset, "denominated": trade.denominated, "quantity": trade.quantity,
-                   "price": trade.price}
-                  for trade in self.trades]
-        return pd.DataFrame(trades)
+        return pd.DataFrame({"trade_time": pd.to_datetime(self.trade_times), "book": self.books,
+                             "direction": self.directions, "asset": self.asset,
+                             "denominated": self.denominations, "quantity": self.quantities,
+                             "price": self.prices})
 
-    def get_trades(self, as_of_time=datetime.now()) -> pd.DataFrame:
+    def get_trades(self, as_of_time=None) -> pd.DataFrame:
         """
         Return a DataFrame of trades in the position, filtered by as_of_time
         which defaults to datetime.now()
         :param as_of_time: Time to filter the list of trades, default is datetime.now()
         :return: DataFrame of trades as of the as_of_time param
         """
+        if as_of_time is None:
+            as_of_time = datetime.now()
+
         trades = self.get_trades_as_dataframe()
         trades_filtered = trades[trades["trade_time"] <= as_of_time]
         return trades_filtered
@@ -282,8 +326,10 @@ class Position:
         if as_of_time is None:
             return self.quantity
         else:
-            trades = self.get_trades(as_of_time)
-            return trades["quantity"].sum()
+            # Sum the quantities of trades booked by as_of_time
+            trade_times = np.asarray(self.trade_times, dtype="datetime64[ns]")
+            quantities = np.asarray(self.quantities)
+            return quantities[trade_times <= np.datetime64(as_of_time, "ns")].sum()
 
 
 class Exchange:
@@ -299,7 +345,17 @@ class Exchange:
     Methods
     -------
     get_close_prices():
+        Load closing prices for assets, from cache if available.
+    get_cached_close_prices(prices_date):
+        Load closing prices for assets from the prices cache file, or Yahoo Finance if stale.
+    read_prices_cache(prices_date):
+        Load closing prices for assets from the prices cache file, None if unusable.
+    write_prices_cache(prices_date, closing_prices):
+        Save closing prices for assets to the prices cache file.
+    fetch_close_prices():
         Load closing prices for assets from Yahoo Finance.
+    get_close_price(asset, start_date, end_date):
+        Load the closing price for a single asset from Yahoo Finance.
     at_market_order(book, asset, quantity):
         Allows an order to be created in the market. Returns trade to book.
     """
@@ -314,19 +370,103 @@ class Exchange:
 
     @staticmethod
     def get_close_prices() -> dict:
+        """
+        Get closing prices for supported assets, shared by all
+        Exchange objects in this process for the day
+        :return: Dictionary of closing prices
+        """
+        return dict(Exchange.get_cached_close_prices(datetime.today().date()))
+
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def get_cached_close_prices(prices_date: date) -> dict:
+        """
+        Get closing prices from the prices cache file if it was written
+        for prices_date within PRICES_CACHE_TTL, otherwise from Yahoo Finance
+        :param prices_date: The date the prices are for
+        :return: Dictionary of closing prices
+        """
+        closing_prices = Exchange.read_prices_cache(prices_date)
+        if closing_prices is None:
+            closing_prices = Exchange.fetch_close_prices()
+            Exchange.write_prices_cache(prices_date, closing_prices)
+        return closing_prices
+
+    @staticmethod
+    def read_prices_cache(prices_date: date):
+        """
+        Get closing prices from the prices cache file, if it was written
+        for prices_date within PRICES_CACHE_TTL and has every supported asset
+        :param prices_date: The date the prices are for
+        :return: Dictionary of closing prices, or None if the cache cannot be used
+        """
+        # A missing, stale, empty or unreadable cache file is treated as a cache miss
+        try:
+            cache_age = datetime.now() - datetime.fromtimestamp(os.path.getmtime(PRICES_CACHE_FILE))
+            if cache_age >= PRICES_CACHE_TTL:
+                return None
+            cached_prices = pd.read_csv(PRICES_CACHE_FILE)
+            cached_prices = cached_prices[cached_prices["date"] == prices_date.isoformat()]
+            closing_prices = dict(zip(cached_prices["asset"], cached_prices["close"]))
+        except (OSError, ValueError, KeyError):
+            return None
+        if not set(SUPPORTED_ASSETS) <= closing_prices.keys():
+            return None
+        return closing_prices
+
+    @staticmethod
+    def write_prices_cache(prices_date: date, closing_prices: dict) -> None:
+        """
+        Save closing prices to the prices cache file. The file is written
+        in full then moved into place, so readers never see a partial file.
+        Failing to write the cache only logs a warning.
+        :param prices_date: The date the prices are for
+        :param closing_prices: Dictionary of closing prices
+        """
+        cache_prices = pd.DataFrame({"date": prices_date.isoformat(), "asset": list(closing_prices.keys()),
+                                     "close": list(closing_prices.values())})
+        temp_file = None
+        try:
+            cache_dir = os.path.dirname(PRICES_CACHE_FILE)
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_fd, temp_file = tempfile.mkstemp(dir=cache_dir, suffix=".csv")
+            with os.fdopen(temp_fd, "w", newline="") as temp:
+                cache_prices.to_csv(temp, index=False)
+            os.replace(temp_file, PRICES_CACHE_FILE)
+        except OSError as error:
+            log.warning("Could not write prices cache %s: %s", PRICES_CACHE_FILE, error)
+            if temp_file is not None and os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    @staticmethod
+    def fetch_close_prices() -> dict:
         """
         Get closing prices from Yahoo Finance for supported assets
         :return: Dictionary of closing prices
         """
         start_date = datetime.today() + timedelta(days=-1)
         end_date = datetime.today()
-        closing_prices = {}
-        for asset in SUPPORTED_ASSETS:
-            close_data = data.DataReader(asset + "-USD", PRICES_SOURCE, start_date, end_date)
-            last_close = close_data["Close"].head(1)
-            closing_prices[asset] = last_close.values[0]
+
+        # Each asset is a separate request, so make them concurrently
+        with ThreadPoolExecutor(max_workers=len(SUPPORTED_ASSETS)) as executor:
+            last_closes = executor.map(lambda asset: Exchange.get_close_price(asset, start_date, end_date),
+                                       SUPPORTED_ASSETS)
+            closing_prices = dict(zip(SUPPORTED_ASSETS, last_closes))
         return closing_prices
 
+    @staticmethod
+    def get_close_price(asset: str, start_date: datetime, end_date: datetime) -> float:
+        """
+        Get the closing price from Yahoo Finance for a given asset
+        :param asset: The asset to get the closing price for
+        :param start_date: Start date of the price history
+        :param end_date: End date of the price history
+        :return: The first closing price in the given dates
+        """
+        close_data = data.DataReader(asset + "-USD", PRICES_SOURCE, start_date, end_date)
+        last_close = close_data["Close"].head(1)
+        return last_close.values[0]
+
     def at_market_order(self, book: str, asset: str, quantity: float, trade_time: datetime) -> Trade:
         """
         Submit an order at market and return the Trade
@@ -349,10 +489,14 @@ class Hedger:
     ----------
     exchange: Exchange
         Connected Exchange for execution.
-    client_trades_file: str
-        File path for client trades file.
+    client_trades_file: str or file-like
+        File path for client trades file, or a file-like object of its contents.
     client_trades: DataFrame
         The client trades loaded from client_trades_file into a DataFrame.
+    client_trade_times: ndarray
+        The sorted trade times of client_trades, used for time window lookups.
+    client_cycle_times: ndarray
+        The sorted hedger cycle times at which client trades are booked.
     client_book: Book
         The Book for holding client positions.
     hedge_book: Book
@@ -363,18 +507,30 @@ class Hedger:
         When to start the hedger.
     end_time: datetime
         When to stop the hedger.
-    execution_queue: List
+    execution_queue: deque
         A queue of hedging trades.
+    slow_time_window: int
+        The SLOW strategy client volume window in minutes, see STRATEGY_PARAMETERS.
+    slow_client_volume_max: float
+        The SLOW strategy client volume threshold, see STRATEGY_PARAMETERS.
+    stealth_client_volume_trigger: float
+        The STEALTH strategy client notional trigger, see STRATEGY_PARAMETERS.
+    stealth_execution_chunks: int
+        The number of STEALTH strategy execution chunks, see STRATEGY_PARAMETERS.
     Methods
     -------
-    log(message):
-        Simple standard logging method.
     trades_net_by_position(trades):
         Returns the net positions from a DataFrame of trades.
     trades_net_by_notional(trades):
         Returns the net notionals from a DataFrame of trades.
-    load_client_trades(file):
-        Loads a given csv file of client trades for hedging.
+    net_by_asset(assets, values):
+        Returns the values summed by asset.
+    read_client_trades(client_trades_file):
+        Reads a given csv file of client trades into a DataFrame.
+    load_client_trades(client_trades):
+        Loads client trades for hedging, from client_trades_file unless a DataFrame is given.
+    client_trades_window(start_time, end_time):
+        Returns the row positions of client trades within the given time window.
     client_trades_by_time(start_time, end_time):
         Returns a DataFrame of client trades within the given time window.
     book_client_trades(start_time, end_time):
@@ -391,6 +547,8 @@ class Hedger:
         Main method for getting quantities for hedges, based on strategy.
     place_hedge_orders(hedge_positions):
         Interface to the Exchange for order placement.
+    next_cycle_time(hedger_time):
+        Returns the time of the next hedging cycle which has work to do.
     run_hedging():
         Runs the main hedging logic.
     save_hedge_trades():
@@ -398,28 +556,28 @@ class Hedger:
     run():
         Main method for the class.
     """
-    def __init__(self, client_trades_file: str):
+    def __init__(self, client_trades_file: Union[str, IO]):
         """
         Constructor for Hedger class
-        :param client_trades_file: The path to the client trades file
+        :param client_trades_file: The path to the client trades file, or a file-like object
         """
         self.exchange = Exchange("MY EXCHANGE")
         self.client_trades_file = client_trades_file
         self.client_trades = pd.DataFrame()
+        self.client_trade_times = np.array([], dtype="datetime64[ns]")
+        self.client_cycle_times = np.array([], dtype="datetime64[ns]")
         self.client_book = Book("CLIENT BOOK")
         self.hedge_book = Book("HEDGE BOOK")
         self.portfolio = Portfolio("Hedging Portfolio", [self.client_book, self.hedge_book])
         self.start_time = None
         self.end_time = None
-        self.execution_queue = []
+        self.execution_queue = deque()
 
-    @staticmethod
-    def log(message: str) -> None:
-        """
-        Standardized logging function
-        :return: None
-        """
-        print(str(datetime.now()) + ": " + message)
+        # Strategy parameters are read every cycle, so look them up once here
+        self.slow_time_window = STRATEGY_PARAMETERS[STRATEGY_SLOW]["time_window"]
+        self.slow_client_volume_max = STRATEGY_PARAMETERS[STRATEGY_SLOW]["client_volume_max"]
+        self.stealth_client_volume_trigger = STRATEGY_PARAMETERS[STRATEGY_STEALTH]["client_volume_trigger"]
+        self.stealth_execution_chunks = STRATEGY_PARAMETERS[STRATEGY_STEALTH]["execution_chunks"]
 
     @staticmethod
     def trades_net_by_position(trades: pd.DataFrame) -> dict:
@@ -428,10 +586,7 @@ class Hedger:
         :param trades: DataFrame of trades
         :return: Dictionary of net positions
         """
-        net_position = Counter()
-        for index, row in trades.iterrows():
-            net_position.update({row["asset"]: row["quantity"]})
-        return net_position
+        return Hedger.net_by_asset(trades["asset"], trades["quantity"].values)
 
     @staticmethod
     def trades_net_by_notional(trades: pd.DataFrame) -> dict:
@@ -440,10 +595,21 @@ class Hedger:
         :param trades: DataFrame of trades
         :return: Dictionary of net notionals
         """
-        net_notional = Counter()
-        for index, row in trades.iterrows():
-            net_notional.update({row["asset"]: row["quantity"]*row["price"]})
-        return net_notional
+        # Notional is precomputed as quantity * price when client trades are loaded
+        return Hedger.net_by_asset(trades["asset"], trades["notional"].values)
+
+    @staticmethod
+    def net_by_asset(assets: pd.Series, values: np.ndarray) -> dict:
+        """
+        Sums values by asset in a single pass over integer asset codes
+        :param assets: Series of asset names
+        :param values: Array of values aligned with assets
+        :return: Dictionary of summed values keyed by asset, in order of first appearance
+        """
+        codes, uniques = pd.factorize(assets)
+        totals = np.zeros(len(uniques), dtype=values.dtype)
+        np.add.at(totals, codes, values)
+        return dict(zip(uniques, totals.tolist()))
 
     @staticmethod
     def get_hedge_quantities_normal(current_positions: dict):
@@ -463,31 +629,72 @@ class Hedger:
         Simple method to print the hedging parameters,
         used on start up.
         """
-        self.log("Hedger Parameters:")
-        self.log("STRATEGY SLOW:")
-        self.log("Client Flow Max: " + str(STRATEGY_PARAMETERS[STRATEGY_SLOW]["client_volume_max"]))
-        self.log("Client Flow Time Window: " + str(STRATEGY_PARAMETERS[STRATEGY_SLOW]["time_window"]))
-        self.log("STRATEGY STEALTH:")
-        self.log("Client Volume Trigger: " + str(STRATEGY_PARAMETERS[STRATEGY_STEALTH]["client_volume_trigger"]))
-        self.log("Execution Chunks: " + str(STRATEGY_PARAMETERS[STRATEGY_STEALTH]["execution_chunks"]))
+        log.info("Hedger Parameters:")
+        log.info("STRATEGY SLOW:")
+        log.info("Client Flow Max: %s", self.slow_client_volume_max)
+        log.info("Client Flow Time Window: %s", self.slow_time_window)
+        log.info("STRATEGY STEALTH:")
+        log.info("Client Volume Trigger: %s", self.stealth_client_volume_trigger)
+        log.info("Execution Chunks: %s", self.stealth_execution_chunks)
+
+    # Opens client trades files by path, can be replaced to read them from elsewhere
+    _open = staticmethod(open)
 
-    def load_client_trades(self) -> None:
+    @staticmethod
+    def read_client_trades(client_trades_file: Union[str, IO]) -> pd.DataFrame:
         """
-        Loads trades from the client trades file and books
-        them in the client book.
+        Reads client trades from a csv file
+        :param client_trades_file: The path to the client trades file, or a file-like object
+        :return: DataFrame of client trades
         """
-        # Date formatter
-        def date_parser(x): return datetime.strptime(x, "%Y/%m/%d %H:%M:%S")
-
         # Throws a FileNotFoundError if the file does not exist
-        self.client_trades = pd.read_csv(self.client_trades_file, parse_dates=["trade_time"], date_parser=date_parser)
-        self.client_trades["notional"] = self.client_trades["quantity"] * self.client_trades["price"]
-        self.client_trades = self.client_trades.sort_values(by="trade_time")
+        if isinstance(client_trades_file, (str, os.PathLike)):
+            with Hedger._open(client_trades_file) as client_trades:
+                return Hedger.read_client_trades(client_trades)
+
+        # Trade times have a fixed format, and the repeated string columns are stored as categories
+        return pd.read_csv(client_trades_file, engine="c", parse_dates=["trade_time"],
+                           date_format="%Y/%m/%d %H:%M:%S",
+                           dtype={"direction": "category", "asset": "category", "denominated": "category"})
+
+    def load_client_trades(self, client_trades=None) -> None:
+        """
+        Loads trades from the client trades file, or the given
+        DataFrame of client trades, for booking in the client book.
+        :param client_trades: DataFrame of client trades, default None reads client_trades_file
+        """
+        if client_trades is None:
+            client_trades = self.read_client_trades(self.client_trades_file)
+
+        # Sorting copies the trades, so a given DataFrame is never modified
+        self.client_trades = client_trades.sort_values(by="trade_time")
+        self.client_trades["notional"] = np.multiply(self.client_trades["quantity"].values,
+                                                     self.client_trades["price"].values)
+        self.client_trade_times = self.client_trades["trade_time"].values
 
         # Initialise the hedger time to just before first client trade
         self.start_time = self.client_trades["trade_time"].min() + timedelta(minutes=-1)
         self.end_time = self.client_trades["trade_time"].max()
 
+        # Each hedger cycle books the trades in (cycle time - 1 minute, cycle time],
+        # so round each trade up to the end of the cycle which books it
+        cycle = np.timedelta64(1, "m")
+        start_time = np.datetime64(self.start_time, "ns")
+        cycles_since_start = -((start_time - self.client_trade_times) // cycle)
+        self.client_cycle_times = np.unique(start_time + cycles_since_start * cycle)
+
+    def client_trades_window(self, start_time: datetime, end_time: datetime) -> Tuple[int, int]:
+        """
+        Provides the row positions of client trades in the time range given
+        :param start_time: Start time of the trades window (exclusive)
+        :param end_time: End time of the trades window (inclusive)
+        :return: Tuple of first and last (exclusive) row positions
+        """
+        # Client trades are sorted by time, so binary search for the (start_time, end_time] window
+        first = np.searchsorted(self.client_trade_times, np.datetime64(start_time, "ns"), side="right")
+        last = np.searchsorted(self.client_trade_times, np.datetime64(end_time, "ns"), side="right")
+        return first, last
+
     def client_trades_by_time(self, start_time: datetime, end_time: datetime) -> pd.DataFrame:
         """
         Provides a client of client trades filtered by time range given
@@ -495,8 +702,8 @@ class Hedger:
         :param end_time: End time of the trades window
         :return: DataFrame of client trades filtered by the time window given
         """
-        mask = (self.client_trades["trade_time"] > start_time) & (self.client_trades["trade_time"] <= end_time)
-        client_trades_filtered = self.client_trades[mask]
+        first, last = self.client_trades_window(start_time, end_time)
+        client_trades_filtered = self.client_trades.iloc[first:last]
         return client_trades_filtered
 
     def book_client_trades(self, start_time: datetime, end_time: datetime) -> pd.DataFrame:
@@ -507,9 +714,10 @@ class Hedger:
         :return: DataFrame of the trades booked
         """
         trades_to_book = self.client_trades_by_time(start_time, end_time)
-        for index, row in trades_to_book.iterrows():
-            trade = Trade(self.client_book.name, row["trade_time"], row["asset"],
-                          row["denominated"], row["quantity"], row["price"])
+        for trade_time, asset, denominated, quantity, price in zip(
+                trades_to_book["trade_time"], trades_to_book["asset"], trades_to_book["denominated"],
+                trades_to_book["quantity"], trades_to_book["price"]):
+            trade = Trade(self.client_book.name, trade_time, asset, denominated, quantity, price)
             self.client_book.trade_add(trade)
         return trades_to_book
 
@@ -531,12 +739,12 @@ class Hedger:
 
         # Time window begins at passed as of time for the
         # given number of minutes back from that
-        end_time = as_of_time
-        start_time = end_time + timedelta(minutes=-sampling_window)
+        end_time = np.datetime64(as_of_time, "ns")
+        start_time = end_time - np.timedelta64(sampling_window, "m")
 
         # Return volume in notional terms (quantity * price)
-        filtered_client_trades = self.client_trades_by_time(start_time, end_time)
-        total_volume = filtered_client_trades["notional"].sum()
+        first, last = self.client_trades_window(start_time, end_time)
+        total_volume = self.client_trades["notional"].values[first:last].sum()
 
         return total_volume
 
@@ -549,14 +757,11 @@ class Hedger:
         :return: One of SUPPORTED_STRATEGIES, e.g. SLOW, NORMAL, STEALTH
         """
         # 1. Check for SLOW conditions
-        time_window = STRATEGY_PARAMETERS[STRATEGY_SLOW]["time_window"]
-        client_volume_max = STRATEGY_PARAMETERS[STRATEGY_SLOW]["client_volume_max"]
-        if self.recent_client_volume(time_window, hedger_time) < client_volume_max:
+        if self.recent_client_volume(self.slow_time_window, hedger_time) < self.slow_client_volume_max:
             return STRATEGY_SLOW
 
         # 2. Check for STEALTH conditions
-        client_volume_trigger = STRATEGY_PARAMETERS[STRATEGY_STEALTH]["client_volume_trigger"]
-        if sum(client_notional_change.values()) > client_volume_trigger:
+        if sum(client_notional_change.values()) > self.stealth_client_volume_trigger:
             return STRATEGY_STEALTH
 
         return STRATEGY_NORMAL
@@ -567,17 +772,15 @@ class Hedger:
         :param current_positions: Dictionary of current positions
         :return: A list of hedges to go into the execution queue
         """
-        stealth_hedges_by_asset = {}
-        for asset, quantity in current_positions.items():
-            stealth_hedges_by_asset[asset] = []
-            chunks = STRATEGY_PARAMETERS[STRATEGY_STEALTH]["execution_chunks"]
-            multiplier = -1 if quantity >= 0 else 1
-            for chunk in range(0, chunks):
-                hedge = {asset: multiplier*quantity/chunks}
-                stealth_hedges_by_asset[asset].append(hedge)
+        # Each chunk offsets an equal share of every position
+        chunks = self.stealth_execution_chunks
+        quantities = np.fromiter(current_positions.values(), dtype=float, count=len(current_positions))
+        chunk_quantities = -quantities / chunks
+        chunk_hedges = [{asset: chunk_quantity}
+                        for asset, chunk_quantity in zip(current_positions.keys(), chunk_quantities.tolist())]
 
-        # Interleave the lists of hedges
-        stealth_hedges = [val for tup in zip(*stealth_hedges_by_asset.values()) for val in tup]
+        # Interleave the hedges so each chunk hedges every asset in turn
+        stealth_hedges = chunk_hedges * chunks
 
         return stealth_hedges
 
@@ -609,17 +812,17 @@ class Hedger:
         # then we can do some more careful hedging in the market by chunking up
         # the position over time.
         if strategy not in SUPPORTED_STRATEGIES:
-            raise Exception("Unknown hedging strategy " + strategy)
+            raise UnknownStrategyError("Unknown hedging strategy " + strategy)
 
         # We could avoid this with match / case etc. in > Python 3.8
-        hedge_quantities = Counter()
+        hedge_quantities = {}
         if strategy == STRATEGY_NORMAL:
-            self.log("Setting strategy to NORMAL")
+            log.info("Setting strategy to NORMAL")
             hedge_quantities = self.get_hedge_quantities_normal(client_position_change)
         elif strategy == STRATEGY_SLOW:
-            self.log("Client activity is slow, setting strategy to SLOW")
+            log.info("Client activity is slow, setting strategy to SLOW")
         elif strategy == STRATEGY_STEALTH:
-            self.log("Large position change, setting strategy to STEALTH")
+            log.info("Large position change, setting strategy to STEALTH")
             for hedge in self.get_hedge_quantities_stealth(current_positions):
                 self.execution_queue.append(hedge)
         else:
@@ -629,7 +832,8 @@ class Hedger:
         # If there are any hedges in the execution queue then pop
         # and include in quantities for hedging
         if len(self.execution_queue) > 0:
-            hedge_quantities.update(self.execution_queue.pop(0))
+            for asset, quantity in self.execution_queue.popleft().items():
+                hedge_quantities[asset] = hedge_quantities.get(asset, 0) + quantity
 
         return hedge_quantities
 
@@ -642,10 +846,24 @@ class Hedger:
         :return: None
         """
         for asset, quantity in hedge_positions.items():
-            self.log("Placing order for: " + str(quantity) + " " + asset)
+            log.info("Placing order for: %s %s", quantity, asset)
             hedge_trade = self.exchange.at_market_order(self.hedge_book.name, asset, quantity, trade_time)
             self.hedge_book.trade_add(hedge_trade)
 
+    def next_cycle_time(self, hedger_time: np.datetime64) -> np.datetime64:
+        """
+        Gets the time of the next hedging cycle. A cycle with no client trades
+        to book and nothing in the execution queue cannot change any positions,
+        so skip ahead to the next cycle which books client trades.
+        :param hedger_time: The current hedger time
+        :return: The hedger time of the next cycle
+        """
+        if len(self.execution_queue) == 0:
+            next_cycle = np.searchsorted(self.client_cycle_times, hedger_time, side="right")
+            if next_cycle < len(self.client_cycle_times):
+                return self.client_cycle_times[next_cycle]
+        return hedger_time + np.timedelta64(1, "m")
+
     def run_hedging(self) -> bool:
         """
         Central method for Hedger class.
@@ -653,45 +871,52 @@ class Hedger:
         set of hedge trades
         :return: Returns True if successful, False otherwise
         """
-        # Print some starting details
-        hedger_time = self.start_time
-        self.log("Starting up...")
+        # Print some starting details. Hedger times are datetime64
+        # so they can be compared directly with client trade times.
+        hedger_time = np.datetime64(self.start_time, "ns")
+        end_time = np.datetime64(self.end_time, "ns")
+        log.info("Starting up...")
         self.log_hedging_parameters()
 
         # Loop until time to stop
-        while hedger_time <= self.end_time or len(self.execution_queue) > 0:
+        while hedger_time <= end_time or len(self.execution_queue) > 0:
             # 0. Update times and log any start up details
-            last_cycle_time = hedger_time
-            hedger_time += timedelta(minutes=1)
-            self.log("CYCLE BEGIN")
-            self.log("Hedger time: " + str(hedger_time))
-            self.log("Last cycle: " + str(last_cycle_time))
-
-            # 1. Book any new client trades since last cycle
-            # and get the client position change
+            hedger_time = self.next_cycle_time(hedger_time)
+            last_cycle_time = hedger_time - np.timedelta64(1, "m")
+            log.info("CYCLE BEGIN")
+            log.info("Hedger time: %s", hedger_time)
+            log.info("Last cycle: %s", last_cycle_time)
+
+            # 1. Book any new client trades since last cycle.
+            # Nothing can be hedged without new client trades or queued hedges.
             client_trades_booked = self.book_client_trades(last_cycle_time, hedger_time)
+            if client_trades_booked.empty and len(self.execution_queue) == 0:
+                log.info("CYCLE END (idle)")
+                continue
+
+            # Get the client position change
             client_position_change = self.trades_net_by_position(client_trades_booked)
-            self.log("Client position change: " + str(client_position_change))
+            log.info("Client position change: %s", client_position_change)
 
             # 2. Check current position
             current_positions = self.portfolio.net_positions()
-            self.log("Current positions: " + str(current_positions))
+            log.info("Current positions: %s", current_positions)
 
             # 3. Decide current hedging strategy
             client_notional_change = self.trades_net_by_notional(client_trades_booked)
             current_strategy = self.get_current_strategy(hedger_time, client_notional_change)
-            self.log(str("Current hedging strategy: " + current_strategy))
+            log.info("Current hedging strategy: %s", current_strategy)
 
             # 4. Decide quantities to hedge
             hedge_quantities = self.get_hedge_quantities(current_positions, client_position_change, current_strategy)
-            self.log(str("Hedge quantities: " + str(hedge_quantities)))
+            log.info("Hedge quantities: %s", hedge_quantities)
 
             # 5. Use connected Exchange to place hedging orders
-            self.place_hedge_orders(hedge_quantities, hedger_time)
-            self.log("Hedge orders booked. Position: " + str(self.portfolio.net_positions()))
+            self.place_hedge_orders(hedge_quantities, pd.Timestamp(hedger_time))
+            log.info("Hedge orders booked. Position: %s", self.portfolio.net_positions())
 
             # 6. Anything else
-            self.log("CYCLE END")
+            log.info("CYCLE END")
         return True
 
     def save_hedge_trades(self) -> None:
@@ -699,7 +924,7 @@ class Hedger:
         Saves the hedge trades to an output csv file
         """
         output_file = "hedge_trades.csv"
-        self.log("Writing Hedge Trades to " + output_file)
+        log.info("Writing Hedge Trades to %s", output_file)
         hedge_trades = self.hedge_book.get_trades()
         hedge_trades.to_csv(output_file)
 
@@ -713,6 +938,8 @@ class Hedger:
 
 
 def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s: %(message)s")
+
     # Change this to your chosen local file path
     trades_file = "client_trades.csv"
     hedger = Hedger(trades_file)
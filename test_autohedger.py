@@ -10,56 +10,231 @@ Version: 1.0
 __author__ = "Matt Webb"
 __version__ = "1.0"
 
+import io
+import logging
+import os
+import pathlib
+import tempfile
+import types
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
 from unittest.mock import patch
 
+import pandas as pd
+
 import autohedger
 from autohedger import Hedger
 
+# Read-only closing prices returned by the mocked Exchange.get_close_prices()
+_MOCK_PRICES = types.MappingProxyType({"BTC": 30000.00, "ETH": 1800.00})
+
+# Test files and the strategy each should trigger
+_CASES = (
+    ("test_stealth.csv", autohedger.STRATEGY_STEALTH),
+    ("test_normal_upper.csv", autohedger.STRATEGY_NORMAL),
+    ("test_normal_lower.csv", autohedger.STRATEGY_NORMAL),
+    ("test_slow.csv", autohedger.STRATEGY_SLOW)
+)
+
+# Test file for a full hedging run
+_SPARSE_FILE = "test_sparse.csv"
+
+# Test files are read from disk once, then opened from memory by Hedger
+_TEST_FILES = tuple(name for name, _ in _CASES) + (_SPARSE_FILE,)
+_VFS = {name: (pathlib.Path(__file__).parent / name).read_text() for name in _TEST_FILES}
+
 
 class test_autohedger(unittest.TestCase):
     """
     Test class for autohedger.
-    Exchange.get_close_prices() is mocked to avoid calls to Yahoo API.
+    Exchange.get_close_prices() is mocked to avoid calls to Yahoo API,
+    and Hedger._open() to read test files from memory.
     """
-    @patch("autohedger.Exchange.get_close_prices", return_value={"BTC": 30000.00, "ETH": 1800.00})
-    def test_hedger_strategies(self, client_trades_file):
+    @classmethod
+    def setUpClass(cls):
+        """
+        Mock Exchange.get_close_prices() and Hedger file opening once for
+        all tests, silence logging and set up the cache of parsed client trades files.
+        """
+        logging.disable(logging.CRITICAL)
+        cls._orig_get_close_prices = autohedger.Exchange.get_close_prices
+        autohedger.Exchange.get_close_prices = staticmethod(lambda: _MOCK_PRICES)
+        cls._orig_open = Hedger._open
+        Hedger._open = staticmethod(lambda path: io.StringIO(_VFS[path]))
+        cls._trade_cache = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        """
+        Restore Exchange.get_close_prices(), Hedger file opening and logging
+        """
+        autohedger.Exchange.get_close_prices = staticmethod(cls._orig_get_close_prices)
+        Hedger._open = staticmethod(cls._orig_open)
+        logging.disable(logging.NOTSET)
+
+    @classmethod
+    def _load_trades(cls, filename):
+        """
+        Reads a client trades file, parsing each file only once
+        :param filename: The client trades file
+        :return: DataFrame of client trades
+        """
+        if filename not in cls._trade_cache:
+            cls._trade_cache[filename] = Hedger.read_client_trades(filename)
+        return cls._trade_cache[filename]
+
+    def _run_case(self, test_file):
+        """
+        Books all the client trades in a test file and determines the strategy
+        :param test_file: The client trades file
+        :return: The resulting hedging strategy
+        """
+        # 1. Initialise and load test file
+        hedger = Hedger(test_file)
+        hedger.load_client_trades(self._load_trades(test_file))
+
+        # 2. Book the client trades and determine strategy
+        client_trades_booked = hedger.book_client_trades(hedger.start_time, hedger.end_time)
+        client_notional_change = hedger.trades_net_by_notional(client_trades_booked)
+        current_strategy = hedger.get_current_strategy(hedger.end_time, client_notional_change)
+
+        # 3. Log some details for transparency
+        autohedger.log.info("Client trades booked: %s", client_trades_booked)
+        autohedger.log.info("Client notional change: %s", client_notional_change)
+        autohedger.log.info("Resulting strategy: %s", current_strategy)
+
+        return current_strategy
+
+    def test_hedger_strategies(self):
         """
         Tests that the given strategy gets triggered
         under the right client trade conditions.
         """
-        test_cases = {
-            "test_stealth.csv": autohedger.STRATEGY_STEALTH,
-            "test_normal_upper.csv": autohedger.STRATEGY_NORMAL,
-            "test_normal_lower.csv": autohedger.STRATEGY_NORMAL,
-            "test_slow.csv": autohedger.STRATEGY_SLOW
-        }
-        for test_file, expected_strategy in test_cases.items():
-            # 1. Initialise and load test file
-            hedger = Hedger(test_file)
-            hedger.load_client_trades()
-
-            # 2. Book the client trades and determine strategy
-            client_trades_booked = hedger.book_client_trades(hedger.start_time, hedger.end_time)
-            client_notional_change = hedger.trades_net_by_notional(client_trades_booked)
-            current_strategy = hedger.get_current_strategy(hedger.end_time, client_notional_change)
-
-            # 3. Log some details for transparency
-            hedger.log("Client trades booked: " + str(client_trades_booked))
-            hedger.log("Client notional change: " + str(client_notional_change))
-            hedger.log("Resulting strategy: " + current_strategy)
-
-            # 4. Check strategy is what we expect
-            self.assertEqual(current_strategy, expected_strategy)
+        # The cases are independent, so run them concurrently. Each case is
+        # checked in its own subTest, so an error in one does not hide the others.
+        with ThreadPoolExecutor(max_workers=len(_CASES)) as executor:
+            futures = [(test_file, executor.submit(self._run_case, test_file), expected_strategy)
+                       for test_file, expected_strategy in _CASES]
+            for test_file, future, expected_strategy in futures:
+                with self.subTest(test_file=test_file):
+                    self.assertEqual(future.result(), expected_strategy)
+
+    def test_hedger_run_hedging(self):
+        """
+        Tests the hedge trades from a full hedging run over sparse client trades,
+        with gaps of minutes and hours between trades, trades off the minute and
+        a client trade booked while STEALTH hedges are still queued.
+        """
+        hedger = Hedger(_SPARSE_FILE)
+        hedger.load_client_trades(self._load_trades(_SPARSE_FILE))
+        hedger.run_hedging()
+
+        hedge_trades = hedger.hedge_book.get_trades()
+        actual = sorted(zip(hedge_trades["trade_time"], hedge_trades["asset"], hedge_trades["quantity"]))
+        expected = [
+            (datetime(2022, 5, 30, 17, 2, 30), "BTC", -80.2),
+            (datetime(2022, 5, 30, 17, 3, 30), "ETH", -0.6),
+            (datetime(2022, 5, 30, 17, 4, 30), "BTC", -80.2),
+            (datetime(2022, 5, 30, 17, 5, 30), "BTC", -3.0),
+            (datetime(2022, 5, 30, 17, 5, 30), "ETH", -0.6),
+            (datetime(2022, 5, 30, 17, 6, 30), "BTC", -80.2),
+            (datetime(2022, 5, 30, 17, 7, 30), "ETH", -0.6),
+            (datetime(2022, 5, 30, 17, 8, 30), "BTC", -80.2),
+            (datetime(2022, 5, 30, 17, 9, 30), "ETH", -0.6),
+            (datetime(2022, 5, 30, 17, 10, 30), "BTC", -80.2),
+            (datetime(2022, 5, 30, 17, 11, 30), "ETH", -0.6),
+            (datetime(2022, 5, 30, 19, 3, 30), "BTC", -66.0),
+            (datetime(2022, 5, 30, 19, 4, 30), "ETH", -0.4),
+            (datetime(2022, 5, 30, 19, 5, 30), "BTC", -66.0),
+            (datetime(2022, 5, 30, 19, 6, 30), "ETH", -0.4),
+            (datetime(2022, 5, 30, 19, 7, 30), "BTC", -66.0),
+            (datetime(2022, 5, 30, 19, 8, 30), "ETH", -0.4),
+            (datetime(2022, 5, 30, 19, 9, 30), "BTC", -66.0),
+            (datetime(2022, 5, 30, 19, 10, 30), "ETH", -0.4),
+            (datetime(2022, 5, 30, 19, 11, 30), "BTC", -66.0),
+            (datetime(2022, 5, 30, 19, 12, 30), "ETH", -0.4),
+            (datetime(2022, 5, 30, 19, 30, 30), "BTC", -5.0)
+        ]
+        self.assertEqual(actual, expected)
+
+    def test_hedger_run_hedging_sub_second(self):
+        """
+        Tests a full hedging run books every client trade
+        when trade times are not whole seconds.
+        """
+        client_trades = self._load_trades(_SPARSE_FILE).copy()
+        milliseconds = [(500, 700, 100)[i % 3] for i in range(len(client_trades))]
+        client_trades["trade_time"] += pd.to_timedelta(milliseconds, unit="ms")
+
+        hedger = Hedger(_SPARSE_FILE)
+        hedger.load_client_trades(client_trades)
+        hedger.run_hedging()
+        self.assertEqual(hedger.client_book.trade_count, len(client_trades))
+
+    def test_exchange_prices_cache_errors(self):
+        """
+        Tests Exchange.get_cached_close_prices falls back to fetching
+        when the prices cache file cannot be read or written.
+        """
+        fetches = []
+
+        def fetch_close_prices():
+            fetches.append(1)
+            return dict(_MOCK_PRICES)
+
+        # Bypass the in-process cache so each call checks the cache file
+        get_cached_close_prices = autohedger.Exchange.get_cached_close_prices.__wrapped__
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch.object(autohedger.Exchange, "fetch_close_prices", staticmethod(fetch_close_prices)):
+            # An empty cache file is a miss, and is replaced by the fetched prices
+            cache_file = os.path.join(cache_dir, "prices.csv")
+            open(cache_file, "w").close()
+            with patch.object(autohedger, "PRICES_CACHE_FILE", cache_file):
+                self.assertEqual(get_cached_close_prices(date(2022, 5, 30)), dict(_MOCK_PRICES))
+                self.assertEqual(autohedger.Exchange.read_prices_cache(date(2022, 5, 30)), dict(_MOCK_PRICES))
+
+            # A cache directory which cannot be created still returns the fetched prices
+            with patch.object(autohedger, "PRICES_CACHE_FILE", os.path.join(cache_file, "prices.csv")):
+                self.assertEqual(get_cached_close_prices(date(2022, 5, 30)), dict(_MOCK_PRICES))
+
+        self.assertEqual(len(fetches), 2)
+
+    def test_hedger_stealth_short_position(self):
+        """
+        Tests STEALTH hedges queued for a short position offset it,
+        rather than adding to the short.
+        """
+        hedger = Hedger(_SPARSE_FILE)
+        current_positions = {"BTC": -330, "ETH": 10}
+        first_hedge = hedger.get_hedge_quantities(current_positions, {}, autohedger.STRATEGY_STEALTH)
+        hedges = [first_hedge] + list(hedger.execution_queue)
+
+        self.assertEqual(hedges, [{"BTC": 66.0}, {"ETH": -2.0}] * hedger.stealth_execution_chunks)
+        for asset, position in current_positions.items():
+            self.assertEqual(sum(hedge.get(asset, 0) for hedge in hedges), -position)
+
+    def test_hedger_normal_with_queued_hedge(self):
+        """
+        Tests a queued STEALTH hedge is added to the NORMAL hedge
+        for the same asset, rather than replacing it.
+        """
+        hedger = Hedger(_SPARSE_FILE)
+        hedger.execution_queue.append({"BTC": -66.0})
+        hedge_quantities = hedger.get_hedge_quantities({}, {"BTC": 3, "ETH": 2}, autohedger.STRATEGY_NORMAL)
+
+        self.assertEqual(hedge_quantities, {"BTC": -69.0, "ETH": -2})
+        self.assertEqual(len(hedger.execution_queue), 0)
 
     def test_hedger_bad_strategy(self):
         """
         Tests Hedger.get_hedge_quantities
         """
-        hedger = Hedger("test_stealth.csv")
-        with self.assertRaises(Exception) as context:
+        # The strategy is validated before any Hedger state is used,
+        # so there is no need to construct one
+        hedger = Hedger.__new__(Hedger)
+        with self.assertRaisesRegex(ValueError, "Unknown hedging strategy"):
             hedger.get_hedge_quantities({}, {}, "BAD")
-        self.assertTrue("Unknown hedging strategy" in str(context.exception))
 
 
 if __name__ == '__main__':